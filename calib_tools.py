@@ -1,6 +1,7 @@
 import puzzlepiece as pzp
 import os
 import time
+import traceback
 import matplotlib.pyplot as plt
 import numpy as np
 from scipy.optimize import curve_fit
@@ -9,7 +10,7 @@ import SantecSLM.patterns as pat
 # from pzp_hardware.oceanoptics import spectrometer
 import SantecSLM.utility as util
 import pandas as pd
-from pyqtgraph.Qt import QtWidgets
+from pyqtgraph.Qt import QtCore, QtWidgets
 from puzzlepiece.extras import hardware_tools as pht
 import pyqtgraph as pg
 
@@ -173,66 +174,169 @@ class UniformAndBinaryCalib(pzp.Piece):
         pzp.param.text(self, self.PARAM_UNIFORM_NAME, pat.UniformPattern.__name__, visible=False)(None)
         pzp.param.text(self, self.PARAM_BINARY_NAME, pat.BinaryGratingPattern.__name__, visible=False)(None)
         pzp.action.settings(self)
+        self._wl_cache = None
+        self._heatmap = None
+        self._measuring = False  # True while a sweep started by the Measure action is running
 
     def define_actions(self):
         @pzp.action.define(self, self.ACTION_MEASURE)
         def measure():
+            if self._measuring:
+                raise RuntimeError("A measurement is already in progress.")
             sample_nb = self[self.PARAM_SAMPLE_NB].value
             min_wl, max_wl = self[self.PARAM_MIN_WL].value, self[self.PARAM_MAX_WL].value
-            wait_time = self[self.PARAM_CAPT_INTERVAL].value / 1000
+            wait_ms = self[self.PARAM_CAPT_INTERVAL].value  # Fractional values are allowed
             grating: pat.BinaryGratingPattern = self.puzzle[self[self.PARAM_BINARY_NAME].value]
             uniform: pat.UniformPattern = self.puzzle[self[self.PARAM_UNIFORM_NAME].value]
             spec: OceanSpectrometer = self.puzzle[self[self.PARAM_SPEC_NAME].value]
             save_name = self[self.PARAM_FILENAME].value
 
-            spec_wavelengths = spec["wls"].value
-            spec_mask = (min_wl <= spec_wavelengths) & (spec_wavelengths <= max_wl)
+            spec_idx, effective_wls = self.get_wavelength_selection(spec["wls"].value, min_wl, max_wl)
 
             mode = self[self.PARAM_MODE].value
             contrasts = np.linspace(0, 1023, sample_nb).astype(int)
-            spectrums = [None] * sample_nb
+            # Filled row by row by the sweep below. Single precision is plenty for spectrometer counts
+            spectrums = np.empty((sample_nb, spec_idx.size), dtype=np.float32)
 
             if mode == self.MODE_EFF:
                 grating[pat.BinaryGratingPattern.PARAM_DUTY_CYCLE].set_value(0.5)
 
-            target_piece = grating if self.MODE_EFF else uniform
+            target_piece = grating if mode == self.MODE_EFF else uniform
+            slm_dim = target_piece.check_slm_status()
+            slm = self.puzzle[target_piece.get_slm_piece_name()]
+
             target_piece[target_piece.PARAM_PHASE].set_value(0)
             target_piece.actions[target_piece.ACTION_SEND]()
-            time.sleep(1)
-            self.puzzle.process_events()
-
-            for i, contrast in enumerate(contrasts):
-                target_piece[target_piece.PARAM_PHASE].set_value(contrast)
-                target_piece.actions[target_piece.ACTION_SEND]()
-                time.sleep(wait_time)
-                self.puzzle.process_events()
-                spectrums[i] = spec["values"].value[spec_mask]
-
-            spectrums = np.array(spectrums)
-
-            nm_per_wl = False
-            nm_all = False
-            if self[self.PARAM_NORMALIZE].value == self.NORM_PER_WL:
-                nm_per_wl = True
-                spectrums /= np.max(spectrums, axis=0)
-            elif self[self.PARAM_NORMALIZE].value == self.NORM_ALL:
-                nm_all = True
-                spectrums /= np.max(spectrums)
-            effective_wls = spec_wavelengths[spec_mask]
-
-            self[self.PARAM_CALIB_DATA].set_value(spectrums)
-            self[self.PARAM_CALIB_WL].set_value(effective_wls)
-
-            plt.imshow(spectrums, origin="lower", aspect="auto", extent=[np.min(effective_wls), np.max(effective_wls), 0, 1023])
-            plt.xlabel("Wavelength (nm)")
-            plt.ylabel("Phase (Grayscale)")
-            cbar = plt.colorbar()
-            cbar.set_label(f"{"Relative" if nm_all or nm_per_wl else ""} Intensity {"per wavelength" if nm_per_wl else ""}")
-            plt.savefig(f"{save_name}.svg")
-            plt.show()
 
-            df = pd.DataFrame(spectrums, index=contrasts, columns=effective_wls)
-            df.to_csv(f"{save_name}.csv")
+            # The pattern of each contrast is generated by the target piece itself, which costs little next to
+            # the settle time and is correct whatever the dependence of the pattern on its phase.
+            def send_pattern(i):
+                target_piece[target_piece.PARAM_PHASE].set_value(contrasts[i])
+                slm[SLMPiece.PARAM_IMAGE].set_value(target_piece.generate_pattern(slm_dim))
+
+            def read_spectrum(i):
+                np.take(spec["values"].value, spec_idx, out=spectrums[i])
+
+            self._measuring = True
+            if not self._has_event_loop():
+                # Single shot timers would never fire, e.g. if called from a worker thread or a script
+                try:
+                    time.sleep(1)
+                    for i in range(sample_nb):
+                        send_pattern(i)
+                        time.sleep(wait_ms/1000)
+                        read_spectrum(i)
+                    self._finish_measurement(spectrums, contrasts, effective_wls, save_name)
+                finally:
+                    self._measuring = False
+                return
+
+            # Qt timers count in whole milliseconds, so the interval is rounded (to 1 ms at least)
+            timer_ms = max(1, round(wait_ms))
+
+            # The sweep is driven by single shot timers rather than time.sleep, so the GUI keeps processing
+            # events while the SLM settles. Each step sends a pattern, then reads the spectrum one sampling interval later.
+            # Exceptions raised in timer callbacks don't reach the caller, so each step stops the sweep and reports them.
+            def send_step(i):
+                try:
+                    send_pattern(i)
+                except Exception:
+                    return self._abort_measurement(f"sending the pattern of contrast {contrasts[i]}")
+                QtCore.QTimer.singleShot(timer_ms, lambda: read_step(i))
+
+            def read_step(i):
+                try:
+                    read_spectrum(i)
+                except Exception:
+                    return self._abort_measurement(f"reading the spectrum of contrast {contrasts[i]}")
+                if i + 1 < sample_nb:
+                    send_step(i + 1)
+                    return
+                try:
+                    self._finish_measurement(spectrums, contrasts, effective_wls, save_name)
+                except Exception:
+                    return self._abort_measurement("saving the measurement")
+                self._measuring = False
+
+            QtCore.QTimer.singleShot(1000, lambda: send_step(0))
+
+    @staticmethod
+    def _has_event_loop():
+        """
+        Whether single shot timers can fire: a Qt application exists and this is its thread.
+        """
+        app = QtCore.QCoreApplication.instance()
+        return app is not None and QtCore.QThread.currentThread() == app.thread()
+
+    def _abort_measurement(self, step):
+        """
+        Stops the sweep of the Measure action after an exception in one of its steps, and reports it.
+        """
+        self._measuring = False
+        print(f"Calibration measurement aborted while {step}:")
+        traceback.print_exc()
+
+    def _finish_measurement(self, spectrums, contrasts, effective_wls, save_name):
+        """
+        Normalizes, stores, plots and saves the spectrums once the sweep started by the Measure action is over.
+        """
+        nm_per_wl = False
+        nm_all = False
+        if self[self.PARAM_NORMALIZE].value == self.NORM_PER_WL:
+            nm_per_wl = True
+            np.divide(spectrums, spectrums.max(axis=0, keepdims=True), out=spectrums)
+        elif self[self.PARAM_NORMALIZE].value == self.NORM_ALL:
+            nm_all = True
+            spectrums *= 1.0 / spectrums.max()
+
+        self[self.PARAM_CALIB_DATA].set_value(spectrums)
+        self[self.PARAM_CALIB_WL].set_value(effective_wls)
+
+        fig, image, cbar = self.get_heatmap_figure()
+        image.set_data(spectrums)
+        image.set_extent([np.min(effective_wls), np.max(effective_wls), 0, 1023])
+        image.autoscale()
+        cbar.set_label(f"{"Relative" if nm_all or nm_per_wl else ""} Intensity {"per wavelength" if nm_per_wl else ""}")
+        fig.savefig(f"{save_name}.svg")
+        plt.show()
+
+        df = pd.DataFrame(spectrums, index=contrasts, columns=effective_wls, copy=False)
+        df.to_csv(f"{save_name}.csv")
+
+    def get_heatmap_figure(self):
+        """
+        Figure, image and colorbar used to plot the measured calibration data.
+        They are created on the first measurement and reused afterwards, as long as the figure window stays open.
+        """
+        if self._heatmap is None or not plt.fignum_exists(self._heatmap[0].number):
+            fig, ax = plt.subplots()
+            image = ax.imshow(np.zeros((1, 1)), origin="lower", aspect="auto")
+            ax.set_xlabel("Wavelength (nm)")
+            ax.set_ylabel("Phase (Grayscale)")
+            cbar = fig.colorbar(image, ax=ax)
+            self._heatmap = (fig, image, cbar)
+        return self._heatmap
+
+    def get_wavelength_selection(self, spec_wavelengths, min_wl, max_wl):
+        """
+        Indices and values of the spectrometer wavelengths within [min_wl, max_wl].
+        The wavelength grid of the spectrometer doesn't change between measurements, so the result
+        is cached and only recomputed when the grid or the range changes.
+
+        :param spec_wavelengths: Wavelength array of the spectrometer
+        :param min_wl: Lower bound of the range (included)
+        :param max_wl: Upper bound of the range (included)
+        """
+        spec_wavelengths = np.asarray(spec_wavelengths)
+        cache = self._wl_cache
+        # Compared by value, the spectrometer returns a new array on every read.
+        # np.array_equal returns early when the shapes differ
+        if cache is not None and cache[1] == (min_wl, max_wl) and np.array_equal(cache[0], spec_wavelengths):
+            return cache[2], cache[3]
+        spec_idx = np.nonzero((min_wl <= spec_wavelengths) & (spec_wavelengths <= max_wl))[0]
+        effective_wls = spec_wavelengths[spec_idx]
+        self._wl_cache = (spec_wavelengths.copy(), (min_wl, max_wl), spec_idx, effective_wls)
+        return spec_idx, effective_wls
 
 # receives row by row calibration data
 # linear interpolation 
@@ -259,34 +363,50 @@ def map_grayscale_to_phase(grayscales, intensities, ignored_samples=1):
     :param intensities:  Measured intensities corresponding to the grayscales
     :param ignored_samples: Ignored sample number to the right and the left of global minimum to avoid experimental imperfections. Mainly due to residual intensities.
     """
-    x, y = grayscales, intensities
-    if np.max(y) > 1:
-        y /= np.max(y)
-
-    slopes = np.sign(np.diff(y, append=y[-1]))
+    x = np.asarray(grayscales)
+    y = np.asarray(intensities, dtype=float)
+    y_max = np.max(y)
+    if y_max > 1:
+        y = y / y_max  # Not in place, the caller's array is left untouched
+
+    # Last slope is replicated instead of being 0
+    slopes = np.empty_like(y)
+    np.sign(np.diff(y), out=slopes[:-1])
+    slopes[-1] = slopes[-2] if slopes.size > 1 else 0
+
+    # End of period: first point after which the curve crosses its first value in the starting direction
     dist_from_1st = np.sign(y - y[0])
-    period_delim = np.sign(np.diff(dist_from_1st, append=dist_from_1st[-1])) == slopes[0]
-
-    if period_delim.size > 1:
-        period_end_idx = np.argmax(period_delim[1:])+1
+    period_delim = np.flatnonzero(np.sign(np.diff(dist_from_1st[1:])) == slopes[0])
+    if period_delim.size > 0:
+        period_end_idx = period_delim[0] + 1
         x = x[0:period_end_idx]
         y = y[0:period_end_idx]
         slopes = slopes[0:period_end_idx]
 
-    ignore_mask = np.ones_like(x, dtype=bool)
-    ignore_mask[np.argmin(y)-ignored_samples : np.argmin(y)+ignored_samples+1] = 0
-    x,y,slopes = x[ignore_mask], y[ignore_mask], slopes[ignore_mask]
-
-    phases = np.acos(np.sqrt(y))
-    phases[slopes > 0] = np.pi - phases[slopes > 0]
+    min_idx = int(np.argmin(y))
+    # Clamped at 0, a negative start would wrap around and ignore nothing
+    ignored = slice(max(0, min_idx - ignored_samples), min_idx + ignored_samples + 1)
+    x, y, slopes = np.delete(x, ignored), np.delete(y, ignored), np.delete(slopes, ignored)
+
+    # Room for the closing (1023, 2pi) point is reserved upfront instead of appending to the arrays
+    n = y.size
+    size = n + (x[-1] != 1023)
+    out_x = np.empty(size, dtype=x.dtype)
+    out_phases = np.empty(size)
+    out_x[:n] = x
+    phases = out_phases[:n]
+
+    np.sqrt(y, out=phases)
+    np.arccos(phases, out=phases)
+    np.subtract(np.pi, phases, out=phases, where=slopes > 0)
     zero_idx = np.argmin(np.abs(phases - 0))
     phases[0:zero_idx] -= np.pi
     phases -= phases[0]
     phases *= 2
-    if x[-1] != 1023:
-        phases = np.append(phases, 2*np.pi)
-        x = np.append(x, 1023)
-    return x, phases
+    if size > n:
+        out_x[-1] = 1023
+        out_phases[-1] = 2*np.pi
+    return out_x, out_phases
 
 
 def linear_interpolation(target, x, y):
@@ -295,23 +415,13 @@ def linear_interpolation(target, x, y):
     using linear interpolation.
     
     :param target: Array that you want to apply the function to.
-    :param x: Arguments
+    :param x: Arguments, in increasing order
     :param y: Images correspondting to the arguments
     """
     if np.min(target) < np.min(x) or np.max(target) > np.max(x):
         raise ValueError("Linear interpolation failed: Some target values not in range of x")
 
-    # Find what coefficients to use
-    diff = np.tile(x, (target.size, 1)).T - target
-    interp_coef_idx = x.size - np.argmax(diff[::-1, :] <= 0, axis=0) - 1
-    # Repeat last value to avoid indexing issues
-    x = np.append(x, x[-1] + 1)  # Avoid divison by zero
-    y = np.append(y, y[-1])
-    
-    # Interpolation formula
-    slope = (y[interp_coef_idx + 1] - y[interp_coef_idx]) / (x[interp_coef_idx + 1] - x[interp_coef_idx])
-    result = y[interp_coef_idx] + (target - x[interp_coef_idx])*slope
-    return result
+    return np.interp(target, x, y)
 
 
 class PhaseCorrector(pat.PatternGenerator):
@@ -334,6 +444,7 @@ class PhaseCorrector(pat.PatternGenerator):
         pzp.param.array(self, self.PARAM_GRAYSCALES, False)(None)
         pzp.param.text(self, self.PARAM_CALIB_FILE, "a.csv", visible=True)(None)
         super().define_params()
+        self._correction_lut = None
 
     def define_actions(self):
         @pzp.action.define(self, "Get correction data")
@@ -351,30 +462,70 @@ class PhaseCorrector(pat.PatternGenerator):
 
             self[self.PARAM_GRAYSCALES].set_value(contrasts_loaded)
 
-            colbycol_calib = []
             col_nb = self.puzzle[self.get_slm_piece_name()][SLMPiece.PARAM_IMAGE].value.shape[1]
             max_wl, min_wl = self[self.PARAM_MAX_WL].value, self[self.PARAM_MIN_WL].value
-            for col in range(col_nb):   # Are wavelengths scattered linearly?? -> Assume yes
-                assumed_wl = min_wl + col*(max_wl - min_wl)/col_nb
-                calib_idx = np.argmin(np.abs(wls - assumed_wl))
-                calib = data[calib_idx, :]
-                colbycol_calib.append(calib)
-            self[self.PARAM_CORRECTION].set_value(np.stack(colbycol_calib))
+            # Are wavelengths scattered linearly?? -> Assume yes
+            assumed_wls = np.linspace(min_wl, max_wl, col_nb, endpoint=False)
+            # Nearest calibration wavelength. wls is sorted, so look up the right neighbour and step back
+            # to the left one when it is at least as close
+            calib_idx = np.clip(np.searchsorted(wls, assumed_wls), 1, wls.size - 1)
+            calib_idx[(assumed_wls - wls[calib_idx - 1]) <= (wls[calib_idx] - assumed_wls)] -= 1
+            # Rows of the file are grayscales, columns are wavelengths
+            self[self.PARAM_CORRECTION].set_value(data.T[calib_idx])
+            self.get_correction_lut()
         super().define_actions()
 
-    def generate_pattern(self, slm_dim):
-        pattern = self.puzzle[self.get_slm_piece_name()][SLMPiece.PARAM_IMAGE].value.T * 2*np.pi
-        ignore = self[self.PARAM_IGNORE].value
+    def get_correction_lut(self):
+        """
+        Column by column lookup table from target grayscale to corrected grayscale. Target grayscales 0 to 1023
+        correspond to phases 0 to 2pi. The table only depends on the correction data and the ignored sample number,
+        so it is cached and recomputed only when one of them changes.
+
+        Returns:
+            A uint16 array of shape (column number, 1024).
+        """
         correction_data = self[self.PARAM_CORRECTION].value
-        grayscales = self[self.PARAM_GRAYSCALES].value
-        corrected_grayscales = []
-        for row in range(pattern.shape[0]):  # I realized later that wavelengths are spread along axis 1 and not 0
-            grayscale, phase = map_grayscale_to_phase(grayscales, correction_data[row,:], ignore)
-            corrected_grayscale = linear_interpolation(pattern[row, :], phase, grayscale)
-            corrected_grayscales.append(corrected_grayscale)
-        corrected_pattern = np.stack(corrected_grayscales, dtype=int).T  # So fix it here
-        return corrected_pattern
-    
+        ignore = self[self.PARAM_IGNORE].value
+        cache = self._correction_lut
+        if cache is None or cache[0] is not correction_data or cache[1] != ignore:
+            grayscales = self[self.PARAM_GRAYSCALES].value
+            target_phases = np.linspace(0, 2*np.pi, 1024)
+            lut = np.empty((correction_data.shape[0], 1024), dtype=np.uint16)
+            for col, calib in enumerate(correction_data):
+                grayscale, phase = map_grayscale_to_phase(grayscales, calib, ignore)
+                # np.interp clamps at the ends, in case the calibrated curve doesn't span the whole [0, 2pi]
+                lut[col] = np.interp(target_phases, phase, grayscale)
+            cache = self._correction_lut = (correction_data, ignore, lut)
+        return cache[2]
+
+    def generate_pattern(self, slm_dim):
+        pattern = self.puzzle[self.get_slm_piece_name()][SLMPiece.PARAM_IMAGE].value
+        if np.min(pattern) < 0 or np.max(pattern) > 1023:
+            raise ValueError("Phase correction failed: Some pattern values not in range [0, 1023]")
+        lut = self.get_correction_lut()
+        # Wavelengths are spread along axis 1, so each column has its own table
+        return lut[np.arange(lut.shape[0]), pattern.astype(np.intp)]
+
+
+def _cos2(x, A, C, D, E):
+    """
+    Intensity model A*cos^2(C*x+D)+E fitted by Polarizer45degHelper.
+    """
+    return A*(np.cos(C*x+D)**2)+E
+
+
+def _cos2_jac(x, A, C, D, E):
+    """
+    Analytic jacobian of _cos2 with respect to (A, C, D, E), of shape (len(x), 4).
+    Saves curve_fit from estimating it with finite differences.
+    """
+    u = C*x + D
+    jac = np.empty((np.size(x), 4))
+    jac[:, 0] = np.cos(u)**2
+    jac[:, 2] = -A*np.sin(2*u)
+    jac[:, 1] = jac[:, 2] * x
+    jac[:, 3] = 1
+    return jac
 
 
 class Polarizer45degHelper(pzp.Piece):
@@ -390,6 +541,7 @@ class Polarizer45degHelper(pzp.Piece):
         pzp.param.spinbox(self, self.PARAM_INTERVAL, 50, 1, 5000, v_step=50)(None)
         pzp.param.text(self, self.PARAM_UNIFORM, pat.UniformPattern.__name__)(None)
         self.fetcher = util.CameraImageFetcher(self.puzzle)
+        self._intensities = None
 
     def define_actions(self):
         @pzp.action.define(self, "Set background image")
@@ -401,7 +553,10 @@ class Polarizer45degHelper(pzp.Piece):
             sample_nb = 40
             self.uniform_generator = self.puzzle[self[self.PARAM_UNIFORM].value]
             phases = np.linspace(0, 1023, sample_nb, dtype=int)
-            intensities = np.zeros_like(phases)
+            # Float buffer reused between calls. Must not inherit the integer dtype of phases
+            if self._intensities is None or self._intensities.size != sample_nb:
+                self._intensities = np.empty(sample_nb, dtype=np.float64)
+            intensities = self._intensities
 
             self.set_phase_and_get_intensity(0)
             time.sleep(1)
@@ -419,25 +574,24 @@ class Polarizer45degHelper(pzp.Piece):
             p0 = [A0, C0, D0, E0]
 
             # Fit
-            cos2_model = lambda x,A,C,D,E: A*(np.cos(C*x+D)**2)+E
-            popt, pcov = curve_fit(cos2_model, phases, intensities, p0=p0)
+            popt, pcov = curve_fit(_cos2, phases, intensities, p0=p0, jac=_cos2_jac, method='lm', xtol=1e-6)
 
             # Find min and max locations
             C_fit = popt[1]
             D_fit = popt[2]
 
             test = np.linspace(0, 1023, 2000, dtype=int)
-            test_image = cos2_model(test, *popt)
+            test_image = _cos2(test, *popt)
             min_x = test[np.argmin(test_image)]
             max_x = test[np.argmax(test_image)]
             self.min_max = (min_x, max_x)
 
             # Just a preview
             x_fit = np.linspace(0, 1023, 1000)
-            y_fit = cos2_model(x_fit, *popt)
+            y_fit = _cos2(x_fit, *popt)
             plt.scatter(phases, intensities)
             plt.plot(x_fit, y_fit)
-            plt.scatter((min_x, max_x), cos2_model(np.array((min_x,max_x)), *popt), c='r')
+            plt.scatter((min_x, max_x), _cos2(np.array((min_x,max_x)), *popt), c='r')
             plt.show()
         
         @pzp.action.define(self, "Measure contrast")
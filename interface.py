@@ -1,4 +1,6 @@
+import asyncio
 import ctypes
+import threading
 from ctypes import wintypes
 import numpy as np
 
@@ -143,17 +145,123 @@ def check_error(return_code, optional_header_msg=""):
     """
     if return_code == SLM_OK:
         return
-    if return_code in ERROR_MSGs.keys():
-        raise RuntimeError(f"{optional_header_msg} SLM returned error code {return_code}. Description: {ERROR_MSGs[return_code]}")
-    else:
-        raise RuntimeError(f"{optional_header_msg} SLM returned unknown error code.")
+    msg = ERROR_MSGs.get(return_code)
+    if msg is None:
+        raise RuntimeError(f"{optional_header_msg} SLM returned unknown error code {return_code}.")
+    raise RuntimeError(f"{optional_header_msg} SLM returned error code {return_code}. Description: {msg}")
+
+def _errcheck(result, func, args):
+    """
+    ctypes errcheck hook of the DLL functions: raises through check_error, otherwise returns the status unchanged.
+    """
+    check_error(result, f"{func.__name__}:")
+    return result
+
+class SLMFrame:
+    """
+    Frame buffer in the layout expected by SLM_Disp_Data: C-contiguous unsigned 16-bit values of shape (height, width).
+    It exposes __array_interface__, so np.asarray(frame) is a writable view of the buffer. Patterns written there
+    are sent with SLM.SLM_Disp_Data_fast without any copy or conversion.
+
+    Args:
+        width (int): Frame width.
+        height (int): Frame height.
+    """
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.buffer = (USHORT * (width * height))()
+        self.ptr = ctypes.cast(self.buffer, LPUSHORT)
+        self.__array_interface__ = {
+            "shape": (height, width),
+            "typestr": "<u2",
+            "data": (ctypes.addressof(self.buffer), False),
+            "version": 3,
+        }
+
+
+def fill_phase_ramp(out, kx, ky, offset=0):
+    """
+    Write the 10-bit linear phase ramp (kx*x + ky*y + offset) mod 1024 into a uint16 array, for example np.asarray(frame)
+    of an SLMFrame. Only two passes over the frame are made, without any full size temporary array.
+
+    Args:
+        out (np.array): C-contiguous uint16 array of shape (height, width), overwritten.
+        kx (int): Grayscale increment per pixel along the width.
+        ky (int): Grayscale increment per pixel along the height.
+        offset (int): Grayscale of the pixel (0, 0).
+
+    Returns:
+        out
+    """
+    height, width = out.shape
+    row = ((kx*np.arange(width) + offset) % 1024).astype(np.uint16)
+    col = ((ky*np.arange(height)) % 1024).astype(np.uint16)
+    # Sums stay below 2048, so a single mask brings them back to [0, 1023]
+    np.add(col[:, None], row[None, :], out=out)
+    np.bitwise_and(out, 0x3FF, out=out)
+    return out
+
+
+def pack_10bit(phase):
+    """
+    Pack 10-bit grayscales tightly, 4 samples in 5 bytes (little endian), for storage or transport of patterns.
+    The SLM itself expects one uint16 per pixel, so packed data must be unpacked before SLM_Disp_Data.
+
+    Args:
+        phase (np.array): Array of positive ints (< 1024). Only the 10 lowest bits are kept.
+
+    Returns:
+        1D uint8 array of 5*ceil(phase.size/4) bytes. The last group is padded with zeros.
+    """
+    flat = np.ravel(phase)
+    groups = np.zeros((-(-flat.size // 4), 4), dtype=np.uint64)
+    groups.ravel()[:flat.size] = flat
+    groups &= 0x3FF
+    words = groups[:, 0] | (groups[:, 1] << 10) | (groups[:, 2] << 20) | (groups[:, 3] << 30)
+    # The 40 used bits of each little endian word are its first 5 bytes
+    return words.astype("<u8").view(np.uint8).reshape(-1, 8)[:, :5].ravel()
+
+
+def unpack_10bit(packed, shape):
+    """
+    Inverse of pack_10bit.
+
+    Args:
+        packed (np.array): uint8 array returned by pack_10bit.
+        shape (tuple): Shape of the original array.
+
+    Returns:
+        uint16 array of the given shape.
+    """
+    size = int(np.prod(shape))
+    words = np.zeros((packed.size // 5, 8), dtype=np.uint8)
+    words[:, :5] = packed.reshape(-1, 5)
+    words = words.view("<u8").ravel()
+    groups = np.empty((words.size, 4), dtype=np.uint16)
+    for i in range(4):
+        groups[:, i] = (words >> (10*i)) & 0x3FF
+    return groups.ravel()[:size].reshape(shape)
+
 
 class SLM:
     def __init__(self, path_to_dll=None):
+        self._ready_events = {}  # SLM number -> (event loop, asyncio.Event), see ready_event
+        self._frame = None  # Reusable buffer of SLM_Disp_Data, see _ensure_frame_buffer
+        self._frame_ptr = None
+        # The DLL calls release the GIL and aren't documented as thread-safe. Calls are serialized per display
+        # and per SLM number (see _lock_for), so a long call on one SLM doesn't block the others or the display.
+        self._disp_locks = {}
+        self._ctrl_locks = {}
+        # Held while the frame buffer of SLM_Disp_Data is filled and read by the DLL
+        self._frame_lock = threading.Lock()
         if path_to_dll is not None:
             self.init_slm(path_to_dll)
 
     def init_slm(self, path):
+        # CDLL (unlike PyDLL) releases the GIL for the duration of each call, so slow calls
+        # (SLM_Ctrl_WriteWL, file reads, data transfers) don't block other Python threads.
+        # The DLL calls themselves are serialized per display and per SLM number, see _lock_for
         self.slm = ctypes.CDLL(path)
         self._link_dll_to_python()
 
@@ -173,6 +281,7 @@ class SLM:
 
         self.slm.SLM_Disp_Data.argtypes = [DWORD, USHORT, USHORT, DWORD, LPUSHORT]
         self.slm.SLM_Disp_Data.restype = SLM_STATUS
+        self._disp_data = self.slm.SLM_Disp_Data  # Bound once, called for every frame
 
         self.slm.SLM_Disp_ReadBMP.argtypes = [DWORD, DWORD, LPCWSTR]
         self.slm.SLM_Disp_ReadBMP.restype = SLM_STATUS
@@ -205,7 +314,31 @@ class SLM:
         self.slm.SLM_Ctrl_WriteAW.argtypes = [DWORD]
         self.slm.SLM_Ctrl_WriteAW.restype = SLM_STATUS
 
-        
+        # Status codes are checked by ctypes right after each call, so callers don't have to.
+        # SLM_Ctrl_ReadSU is left out as it reports busy through its return code.
+        for func in (self.slm.SLM_Disp_Open, self.slm.SLM_Disp_Info, self.slm.SLM_Disp_GrayScale,
+                     self.slm.SLM_Disp_Close, self.slm.SLM_Disp_Data, self.slm.SLM_Disp_ReadBMP,
+                     self.slm.SLM_Disp_ReadCSV, self.slm.SLM_Ctrl_Open, self.slm.SLM_Ctrl_WriteVI,
+                     self.slm.SLM_Ctrl_ReadVI, self.slm.SLM_Ctrl_WriteWL, self.slm.SLM_Ctrl_ReadWL,
+                     self.slm.SLM_Ctrl_Close, self.slm.SLM_Ctrl_WriteAW):
+            func.errcheck = _errcheck
+
+
+    def _lock_for(self, locks, number):
+        """
+        Lock serializing the DLL calls made for one display or SLM number, created on first use.
+        Args:
+            locks (dict): self._disp_locks or self._ctrl_locks.
+            number (int): Display number or SLM number.
+
+        Returns:
+            The threading.Lock of that number.
+        """
+        lock = locks.get(number)
+        if lock is None:
+            # setdefault is atomic, so threads racing here all get the same lock
+            lock = locks.setdefault(number, threading.Lock())
+        return lock
 
     def SLM_Disp_Open(self, DisplayNumber):
         """
@@ -214,9 +347,10 @@ class SLM:
             DisplayNumber (int): Specify display number (1, 2, 3…).
         
         Returns:
-            SLM_OK if successful, otherwise SLM_STATUS error code is returned.
+            SLM_OK. A RuntimeError is raised if the SLM returns an error code.
         """
-        return self.slm.SLM_Disp_Open(DWORD(DisplayNumber))
+        with self._lock_for(self._disp_locks, DisplayNumber):
+            return self.slm.SLM_Disp_Open(DisplayNumber)
     
     def SLM_Disp_Info(self, DisplayNumber):
         """
@@ -226,13 +360,14 @@ class SLM:
         
         Returns:
             Tuple of three elements:
-                0: SLM_OK if successful, otherwise SLM_STATUS error code is returned.
+                0: SLM_OK. A RuntimeError is raised if the SLM returns an error code.
                 1: Width of the display
                 2: Height of the display
         """
         width = USHORT()
         height = USHORT()
-        status = self.slm.SLM_Disp_Info(DWORD(DisplayNumber), ctypes.byref(width), ctypes.byref(height))
+        with self._lock_for(self._disp_locks, DisplayNumber):
+            status = self.slm.SLM_Disp_Info(DisplayNumber, ctypes.byref(width), ctypes.byref(height))
         return status, width.value, height.value
     
     def SLM_Disp_GrayScale(self, DisplayNumber, Flags, GrayScale):
@@ -244,9 +379,10 @@ class SLM:
             GrayScale (int): Specify grayscale from 0 to 1023 (0pi to 2pi).
         
         Returns:
-            SLM_OK if successful, otherwise SLM_STATUS error code is returned.
+            SLM_OK. A RuntimeError is raised if the SLM returns an error code.
         """
-        return self.slm.SLM_Disp_GrayScale(DWORD(DisplayNumber), DWORD(Flags), USHORT(GrayScale))
+        with self._lock_for(self._disp_locks, DisplayNumber):
+            return self.slm.SLM_Disp_GrayScale(DisplayNumber, Flags, GrayScale)
 
     def SLM_Disp_Close(self, DisplayNumber):
         """
@@ -255,9 +391,10 @@ class SLM:
             DisplayNumber (int): Specify display number (1, 2, 3…).
         
         Returns:
-            SLM_OK if successful, otherwise SLM_STATUS error code is returned.
+            SLM_OK. A RuntimeError is raised if the SLM returns an error code.
         """
-        return self.slm.SLM_Disp_Close(DWORD(DisplayNumber))
+        with self._lock_for(self._disp_locks, DisplayNumber):
+            return self.slm.SLM_Disp_Close(DisplayNumber)
 
     def SLM_Disp_Data(self, DisplayNumber, width, height, Flags, data):
         """
@@ -267,15 +404,68 @@ class SLM:
             width (int): Specify display width value.
             height (int): Specify display height value.
             Flags (int): Use this to change the display method.
-            data (np.array): Numpy array of positive ints (< 1024) with dimension (height, width)  
+            data (np.array): Numpy array of positive ints (< 1024) with dimension (height, width).
+                A C-contiguous uint16 array is passed as is, anything else is copied into a reused buffer
+                with values clipped to [0, 1023]. The buffer is shared by all displays and locked until the DLL has
+                read it, so it isn't overwritten meanwhile. Other calls on the same display wait for this one.
         
         Returns:
-            SLM_OK if successful, otherwise SLM_STATUS error code is returned.
+            SLM_OK. A RuntimeError is raised if the SLM returns an error code.
         """
-        ptr = np.ascontiguousarray(data.flatten().astype(np.int16)).ctypes.data_as(LPUSHORT)
-        return self.slm.SLM_Disp_Data(DWORD(DisplayNumber), USHORT(width), USHORT(height),
-                                      DWORD(Flags), ptr)
+        # A C-contiguous 2D array has the same layout as the flattened one expected by the DLL.
+        # The caller holds data for the duration of the call, so the pointer can be passed directly
+        # Plain ints are converted by ctypes according to argtypes
+        with self._lock_for(self._disp_locks, DisplayNumber):
+            if data.dtype == np.uint16 and data.flags.c_contiguous and data.shape == (height, width):
+                return self._disp_data(DisplayNumber, width, height, Flags, data.ctypes.data_as(LPUSHORT))
+            with self._frame_lock:
+                frame, ptr = self._ensure_frame_buffer(width, height)
+                # Clipping in the same pass as the copy, so negative or too large values don't wrap around
+                np.clip(data, 0, 1023, out=frame, casting='unsafe')
+                return self._disp_data(DisplayNumber, width, height, Flags, ptr)
+
+    def _ensure_frame_buffer(self, width, height):
+        """
+        Buffer into which SLM_Disp_Data converts arrays that can't be passed as is. It is allocated once,
+        and again only when the dimension changes. Must be called with _frame_lock held.
+        Args:
+            width (int): Specify display width value.
+            height (int): Specify display height value.
+
+        Returns:
+            The uint16 array of shape (height, width) and its pointer.
+        """
+        if self._frame is None or self._frame.shape != (height, width):
+            self._frame = np.empty((height, width), dtype=np.uint16)
+            self._frame_ptr = self._frame.ctypes.data_as(LPUSHORT)
+        return self._frame, self._frame_ptr
     
+    def alloc_frame(self, width, height):
+        """
+        Allocate a frame buffer that can be filled in place and sent with SLM_Disp_Data_fast.
+        Args:
+            width (int): Specify display width value.
+            height (int): Specify display height value.
+
+        Returns:
+            SLMFrame of the given dimension. Use np.asarray(frame) to write into it.
+        """
+        return SLMFrame(width, height)
+
+    def SLM_Disp_Data_fast(self, DisplayNumber, Flags, frame):
+        """
+        Display a frame allocated by alloc_frame on the SLM. Same as SLM_Disp_Data, without any conversion of the data.
+        Args:
+            DisplayNumber (int): Specify display number (1, 2, 3…).
+            Flags (int): Use this to change the display method.
+            frame (SLMFrame): Frame buffer containing positive ints (< 1024).
+
+        Returns:
+            SLM_OK. A RuntimeError is raised if the SLM returns an error code.
+        """
+        with self._lock_for(self._disp_locks, DisplayNumber):
+            return self._disp_data(DisplayNumber, frame.width, frame.height, Flags, frame.ptr)
+
     def SLM_Disp_ReadBMP(self, DisplayNumber, Flags, FileName):
         """
         Display array data on the SLM.
@@ -285,9 +475,10 @@ class SLM:
             FileName (str): Python string containing bmp file name.
         
         Returns:
-            SLM_OK if successful, otherwise SLM_STATUS error code is returned.
+            SLM_OK. A RuntimeError is raised if the SLM returns an error code.
         """
-        return self.slm.SLM_Disp_ReadBMP(DWORD(DisplayNumber), DWORD(Flags), FileName)
+        with self._lock_for(self._disp_locks, DisplayNumber):
+            return self.slm.SLM_Disp_ReadBMP(DisplayNumber, Flags, FileName)
 
     def SLM_Disp_ReadCSV(self, DisplayNumber, Flags, FileName):
         """
@@ -298,9 +489,10 @@ class SLM:
             FileName (str): Python string containing csv file name.
         
         Returns:
-            SLM_OK if successful, otherwise SLM_STATUS error code is returned.
+            SLM_OK. A RuntimeError is raised if the SLM returns an error code.
         """
-        return self.slm.SLM_Disp_ReadCSV(DWORD(DisplayNumber), DWORD(Flags), FileName)
+        with self._lock_for(self._disp_locks, DisplayNumber):
+            return self.slm.SLM_Disp_ReadCSV(DisplayNumber, Flags, FileName)
 
 
     # Control functions
@@ -311,20 +503,69 @@ class SLM:
             SLMNumber (int): Specify SLM number (1-8).
         
         Returns:
-            SLM_OK if successful, otherwise SLM_STATUS error code is returned.
+            SLM_OK. A RuntimeError is raised if the SLM returns an error code.
         """
-        return self.slm.SLM_Ctrl_Open(DWORD(SLMNumber))
+        with self._lock_for(self._ctrl_locks, SLMNumber):
+            return self.slm.SLM_Ctrl_Open(SLMNumber)
     
     def SLM_Ctrl_ReadSU(self, SLMNumber):
         """
-        Read status of SLM. Busy or Ready.
+        Read status of SLM. Busy or Ready. Unlike other functions, error codes are returned and not raised,
+        since SLM_BS is the expected answer while the SLM is busy. It is not serialized with the other calls
+        on the SLM, so it can be polled while a long call such as SLM_Ctrl_WriteWL is running.
         Args:
             SLMNumber (int): Specify SLM number (1-8).
         
         Returns:
             SLM_OK if successful, otherwise SLM_STATUS error code is returned.
         """
-        return self.slm.SLM_Ctrl_ReadSU(DWORD(SLMNumber))
+        return self.slm.SLM_Ctrl_ReadSU(SLMNumber)
+
+    def ready_event(self, SLMNumber):
+        """
+        asyncio.Event that wait_ready_async also waits on, so that it returns without waiting for the next poll.
+        Set it from a callback when the application knows the SLM finished earlier (from another thread, use
+        loop.call_soon_threadsafe(event.set)). Must be called from the running event loop: an Event is bound to
+        the loop it is awaited in, so a new one is created when the loop changes (e.g. a later asyncio.run).
+        Args:
+            SLMNumber (int): Specify SLM number (1-8).
+
+        Returns:
+            The asyncio.Event associated with the SLM number and the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        entry = self._ready_events.get(SLMNumber)
+        if entry is None or entry[0] is not loop:
+            entry = (loop, asyncio.Event())
+            self._ready_events[SLMNumber] = entry
+        return entry[1]
+
+    async def wait_ready_async(self, SLMNumber, poll_min=0.001, poll_max=0.1):
+        """
+        Wait until the SLM is no longer busy, without blocking the event loop.
+        SLM_Ctrl_ReadSU is polled in a worker thread, with an interval doubling from poll_min up to poll_max.
+        The polls don't wait for other calls on the SLM, so this also waits for a SLM_Ctrl_WriteWL run in another thread.
+        Args:
+            SLMNumber (int): Specify SLM number (1-8).
+            poll_min (float): First polling interval in seconds.
+            poll_max (float): Longest polling interval in seconds.
+
+        Returns:
+            SLM_OK once the SLM is ready, otherwise the SLM_STATUS error code returned by SLM_Ctrl_ReadSU.
+        """
+        event = self.ready_event(SLMNumber)
+        interval = poll_min
+        while True:
+            status = await asyncio.to_thread(self.SLM_Ctrl_ReadSU, SLMNumber)
+            if status != SLM_BS:
+                event.clear()
+                return status
+            try:
+                await asyncio.wait_for(event.wait(), interval)
+                event.clear()
+            except asyncio.TimeoutError:
+                pass
+            interval = min(2*interval, poll_max)
     
     def SLM_Ctrl_WriteVI(self, SLMNumber, mode):
         """
@@ -334,9 +575,10 @@ class SLM:
             mode (int): Specify mode value. 0:Memory mode, 1:DVI mode
         
         Returns:
-            SLM_OK if successful, otherwise SLM_STATUS error code is returned.
+            SLM_OK. A RuntimeError is raised if the SLM returns an error code.
         """
-        return self.slm.SLM_Ctrl_WriteVI(DWORD(SLMNumber), DWORD(mode))
+        with self._lock_for(self._ctrl_locks, SLMNumber):
+            return self.slm.SLM_Ctrl_WriteVI(SLMNumber, mode)
     
     def SLM_Ctrl_ReadVI(self, SLMNumber):
         """
@@ -346,11 +588,12 @@ class SLM:
         
         Returns:
             Tuple of two elements:
-                0: SLM_OK if successful, otherwise SLM_STATUS error code is returned.
+                0: SLM_OK. A RuntimeError is raised if the SLM returns an error code.
                 1: Mode value: 0=Memory mode, 1=DVI mode
         """
         mode = DWORD()
-        status = self.slm.SLM_Ctrl_ReadVI(DWORD(SLMNumber), ctypes.byref(mode))
+        with self._lock_for(self._ctrl_locks, SLMNumber):
+            status = self.slm.SLM_Ctrl_ReadVI(SLMNumber, ctypes.byref(mode))
         return status, mode.value
     
     def SLM_Ctrl_WriteWL(self, SLMNumber, wavelength, phase):
@@ -365,11 +608,13 @@ class SLM:
                 Note: This phase is the maximum optical phase at specified wavelength, i.e. 1023 corresponds to the phase value given to this parameter.
         
         Returns:
-                SLM_OK if successful, otherwise SLM_STATUS error code is returned.
+                SLM_OK. A RuntimeError is raised if the SLM returns an error code.
 
-        Note: The setting takes approx. 30 to 40 seconds
+        Note: The setting takes approx. 30 to 40 seconds. The GIL is released meanwhile, so this can be run in a worker thread.
+        Other calls on the same SLM number wait until it is done, except SLM_Ctrl_ReadSU. Display calls are not blocked.
         """
-        return self.slm.SLM_Ctrl_WriteWL(DWORD(SLMNumber), DWORD(wavelength), DWORD(phase))
+        with self._lock_for(self._ctrl_locks, SLMNumber):
+            return self.slm.SLM_Ctrl_WriteWL(SLMNumber, wavelength, phase)
     
     def SLM_Ctrl_ReadWL(self, SLMNumber):
         """
@@ -380,13 +625,14 @@ class SLM:
             
         Returns:
             Tuple of two elements:
-                0: SLM_OK if successful, otherwise SLM_STATUS error code is returned.
+                0: SLM_OK. A RuntimeError is raised if the SLM returns an error code.
                 1: Wavelength value: wavelength value. (450-1600)
                 2: phase value multiplied by 100. (0-999)
         """
         wavelength = DWORD()
         phase = DWORD()
-        status = self.slm.SLM_Ctrl_ReadWL(DWORD(SLMNumber), ctypes.byref(wavelength), ctypes.byref(phase))
+        with self._lock_for(self._ctrl_locks, SLMNumber):
+            status = self.slm.SLM_Ctrl_ReadWL(SLMNumber, ctypes.byref(wavelength), ctypes.byref(phase))
         return status, wavelength.value, phase.value
     
     def SLM_Ctrl_WriteAW(self, SLMNumber):
@@ -398,9 +644,10 @@ class SLM:
             SLMNumber (int): Specify SLM number (1-8).
             
         Returns:
-            SLM_OK if successful, otherwise SLM_STATUS error code is returned.
+            SLM_OK. A RuntimeError is raised if the SLM returns an error code.
         """
-        return self.slm.SLM_Ctrl_WriteAW(DWORD(SLMNumber))
+        with self._lock_for(self._ctrl_locks, SLMNumber):
+            return self.slm.SLM_Ctrl_WriteAW(SLMNumber)
     
     def SLM_Ctrl_Close(self, SLMNumber):
         """
@@ -410,9 +657,10 @@ class SLM:
             SLMNumber (int): Specify SLM number (1-8).
             
         Returns:
-            SLM_OK if successful, otherwise SLM_STATUS error code is returned.
+            SLM_OK. A RuntimeError is raised if the SLM returns an error code.
         """
-        return self.slm.SLM_Ctrl_Close(DWORD(SLMNumber))
+        with self._lock_for(self._ctrl_locks, SLMNumber):
+            return self.slm.SLM_Ctrl_Close(SLMNumber)
 
 if __name__ == "__main__":
     slm = SLM("dll/x64/SLMFunc.dll")
@@ -1,9 +1,9 @@
 from SantecSLM.pzp import SLMPiece
 import SantecSLM.utility as util
-import SantecSLM.patterns as pat
 import puzzlepiece as pzp
 import numpy as np
 import matplotlib.pyplot as plt
+import ast
 
 
 # in meters
@@ -45,6 +45,7 @@ generate_pattern(self, slm_dim)
     def define_params(self):
         pzp.param.text(self, self.PARAM_SLM_NAME, slm_name, visible=False)(None)
         pzp.action.settings(self)
+        self._pattern_cache = None
 
     def define_actions(self):
         @pzp.action.define(self, self.ACTION_SEND)
@@ -62,14 +63,14 @@ generate_pattern(self, slm_dim)
         Check SLM availability and dimension.
         
         Returns:
-            If the SLM is connected, return dimension of slm, in the format (height, width)
+            If the SLM is connected, return dimension of slm as a tuple of ints, in the format (height, width)
             Otherwise return None.
         """
         slm = self.puzzle[slm_name]
         if slm[SLMPiece.PARAM_CONNECTED].value is not True:
             raise RuntimeError("SLM is not connected.")
-        slm_dim = slm[SLMPiece.PARAM_SLM_DIMENSIONS].value
-        return slm_dim
+        height, width = slm[SLMPiece.PARAM_SLM_DIMENSIONS].value
+        return (int(height), int(width))
     
     def generate_pattern(self, slm_dim):
         """
@@ -81,9 +82,32 @@ generate_pattern(self, slm_dim)
             slm_dim (tuple[int,int]): contains two integers (height, width), which are returned from check_slm_status()
         
         Returns:
-            A numpy array of shape slm_dim. Any coefficient should be in the range [0, 1023].
+            A numpy array of shape slm_dim, uint16 where possible. Any coefficient should be in the range [0, 1023].
+            A C-contiguous uint16 array is sent to the SLM as is, anything else (other dtypes, broadcast views)
+            is clipped and converted in a single pass into a buffer reused by SLM.SLM_Disp_Data.
         """
-        return np.zeros(slm_dim)
+        return np.zeros(slm_dim, dtype=np.uint16)
+
+    def cached_pattern(self, slm_dim, params, build):
+        """
+        Return the pattern built by build(slm_dim, *params), reusing the last one if neither the dimension nor
+        the parameters changed, so that sending the same pattern again doesn't recompute it.
+
+        Args:
+            slm_dim (tuple[int,int]): Dimension (height, width) of the pattern, passed to build as a tuple of ints.
+            params (tuple): Hashable parameter values on which the pattern depends, passed to build.
+            build (callable): Function generating the pattern.
+
+        Returns:
+            A read-only numpy array. Copy it before modifying it in place.
+        """
+        slm_dim = tuple(map(int, slm_dim))
+        key = (slm_dim, tuple(params))
+        if self._pattern_cache is None or self._pattern_cache[0] != key:
+            pattern = build(slm_dim, *params)
+            pattern.setflags(write=False)
+            self._pattern_cache = (key, pattern)
+        return self._pattern_cache[1]
 
     def send_image_to_slm(self):
         self.puzzle[slm_name][SLMPiece.PARAM_IMAGE].set_value(self.generate_pattern(self.check_slm_status()))
@@ -100,8 +124,8 @@ class UniformPattern(PatternGenerator):
         if slm_dim is None:
             return
         phase = self[self.PARAM_PHASE].value
-        pattern = np.ones(slm_dim)*phase
-        return pattern
+        # A single value broadcast to the SLM dimension, no frame is allocated
+        return self.cached_pattern(slm_dim, (phase,), lambda dim, phase: np.broadcast_to(np.uint16(phase), dim))
     
 
 class BlazedGratingPattern(PatternGenerator):
@@ -115,25 +139,30 @@ class BlazedGratingPattern(PatternGenerator):
         pzp.param.checkbox(self, self.PARAM_HORIZONTAL, False)(None)
         super().define_params()
 
-    def blazed_grating(self, height, width, period_px, max_phase):
-        if self[self.PARAM_HORIZONTAL].value:
-            x = np.arange(width)
-            k = x % period_px
-            row = k * max_phase / (period_px - 1)  # shape (width,)
-            grating = np.tile(row, (height, 1))  # shape (height, width)
+    def blazed_grating(self, slm_dim, period_px, max_phase, horizontal):
+        """
+        The grating is invariant along one axis, so only one row (or column) is computed, by looking up
+        the grayscales of one period.
+
+        Returns:
+            A read-only uint16 broadcast view of shape (height, width). Copy it before modifying it in place.
+        """
+        height, width = slm_dim
+        # Integer division truncates like the conversion of the former float grating sent to the SLM
+        lut = (np.arange(period_px, dtype=np.int32) * max_phase // (period_px - 1)).astype(np.uint16)
+        if horizontal:
+            row = lut[np.arange(width) % period_px]  # shape (width,)
+            grating = np.broadcast_to(row, (height, width))
         else:
-            y = np.arange(height)
-            k = y % period_px
-            col = k * max_phase / (period_px - 1)  # shape (width,)
-            grating = np.tile(col, (width, 1)).T  # shape (height, width)
+            col = lut[np.arange(height) % period_px]  # shape (height,)
+            grating = np.broadcast_to(col[:, None], (height, width))
         return grating
     
     def generate_pattern(self, slm_dim):
-        slm_dim = self.check_slm_status()
         period = self[self.PARAM_PERIOD].value
         max_phase = self[self.PARAM_PHASE].value
-        pattern = self.blazed_grating(slm_dim[0], slm_dim[1], period, max_phase)
-        return pattern
+        horizontal = self[self.PARAM_HORIZONTAL].value
+        return self.cached_pattern(slm_dim, (period, max_phase, horizontal), self.blazed_grating)
 
 
 class BinaryGratingPattern(PatternGenerator):
@@ -150,20 +179,21 @@ class BinaryGratingPattern(PatternGenerator):
         super().define_params()
     
     def generate_pattern(self, slm_dim):
-        slm_dim = self.check_slm_status()
         phase = self[self.PARAM_PHASE].value
         period = self[self.PARAM_PERIOD].value
         duty_cycle = self[self.PARAM_DUTY_CYCLE].value
-        pattern = np.zeros(slm_dim)
-        if self[self.PARAM_HORIZONTAL].value:
-            pattern[:, np.arange(0, slm_dim[1])%period < period*duty_cycle] = phase
+        horizontal = self[self.PARAM_HORIZONTAL].value
+        return self.cached_pattern(slm_dim, (phase, period, duty_cycle, horizontal), self.binary_grating)
+
+    def binary_grating(self, slm_dim, phase, period, duty_cycle, horizontal):
+        # One period is computed, then repeated along the line by np.resize, without any per-pixel modulo
+        one_period = ((np.arange(0, period) < period*duty_cycle)*phase).astype(np.uint16)
+        if horizontal:
+            line = np.resize(one_period, slm_dim[1])[None, :]
         else:
-            pattern[np.arange(0, slm_dim[0])%period < period*duty_cycle, :] = phase
-        return pattern
-
+            line = np.resize(one_period, slm_dim[0])[:, None]
+        return np.broadcast_to(line, tuple(slm_dim))
 
-def clamp(value, min_, max_):
-    return min(max(value, min_), max_)
 
 class SlitPattern(PatternGenerator):
     PARAM_VERTICAL = "Vertical"
@@ -193,30 +223,33 @@ class SlitPattern(PatternGenerator):
         slm_length_px = (slm_dim[1] if vertical else slm_dim[0])
         center_idx = round(slm_length_px / 2) + offset_px
 
-        start = int(clamp(center_idx - half_width_px, 0, slm_length_px))
-        end = int(clamp(center_idx + half_width_px, 0, slm_length_px))
+        start = int(min(max(center_idx - half_width_px, 0), slm_length_px))
+        end = int(min(max(center_idx + half_width_px, 0), slm_length_px))
         if vertical:
             pattern[:, start:end] = phase
         else:
             pattern[start:end, :] = phase
 
     def generate_pattern(self, slm_dim):
-        slm_dim = self.check_slm_status()
         vertical = self[self.PARAM_VERTICAL].value
         double = self[self.PARAM_DOUBLE].value
         width = self[self.PARAM_WIDTH].value
         offset = self[self.PARAM_OFFSET].value
         slit_phase = self[self.PARAM_SLIT_PHASE].value
         nonslit_phase = self[self.PARAM_NONSLIT_PHASE].value
+        distance = self[self.PARAM_DISTANCE].value
+        params = (vertical, double, width, offset, distance, slit_phase, nonslit_phase)
+        return self.cached_pattern(slm_dim, params, self.slits)
 
-        pattern = np.ones(slm_dim)*nonslit_phase
+    def slits(self, slm_dim, vertical, double, width, offset, distance, slit_phase, nonslit_phase):
+        # Slits are invariant along one axis: they are drawn on a single row (or column) which is then broadcast
+        line = np.full((1, slm_dim[1]) if vertical else (slm_dim[0], 1), nonslit_phase, dtype=np.uint16)
         if double:
-            distance = self[self.PARAM_DISTANCE].value
-            self.draw_slit(pattern, vertical, width, offset + distance/2, slm_dim, slit_phase)
-            self.draw_slit(pattern, vertical, width, offset - distance/2, slm_dim, slit_phase)
+            self.draw_slit(line, vertical, width, offset + distance/2, slm_dim, slit_phase)
+            self.draw_slit(line, vertical, width, offset - distance/2, slm_dim, slit_phase)
         else:
-            self.draw_slit(pattern, vertical, width, offset, slm_dim, slit_phase)
-        return pattern
+            self.draw_slit(line, vertical, width, offset, slm_dim, slit_phase)
+        return np.broadcast_to(line, tuple(slm_dim))
 
 
 class PinholePattern(PatternGenerator):
@@ -236,17 +269,28 @@ class PinholePattern(PatternGenerator):
         super().define_params()
 
     def generate_pattern(self, slm_dim):
-        slm_dim = self.check_slm_status()
         radius = self[self.PARAM_RADIUS].value
         offset_x = self[self.PARAM_OFFSET_X].value
         offset_y = self[self.PARAM_OFFSET_Y].value
         slit_phase = self[self.PARAM_SLIT_PHASE].value
         nonslit_phase = self[self.PARAM_NONSLIT_PHASE].value
-
-        pattern = np.ones(slm_dim)*nonslit_phase
-        yy, xx = np.mgrid[:slm_dim[0], :slm_dim[1]]
-        mask = ((xx - offset_x - slm_dim[1]/2)**2 + (yy - offset_y - slm_dim[0]/2)**2) < (radius**2)
-        pattern[mask] = slit_phase
+        params = (radius, offset_x, offset_y, slit_phase, nonslit_phase)
+        return self.cached_pattern(slm_dim, params, self.pinhole)
+
+    def pinhole(self, slm_dim, radius, offset_x, offset_y, slit_phase, nonslit_phase):
+        pattern = np.full(slm_dim, nonslit_phase, dtype=np.uint16)
+        # Squared distances are separable. Both are positive, so the disk lies within the rows and columns
+        # where each of them alone is below radius**2, and the mask is only computed on that bounding box.
+        dx2 = (np.arange(slm_dim[1]) - offset_x - slm_dim[1]/2)**2
+        dy2 = (np.arange(slm_dim[0]) - offset_y - slm_dim[0]/2)**2
+        rows = np.flatnonzero(dy2 < radius**2)
+        cols = np.flatnonzero(dx2 < radius**2)
+        if rows.size == 0 or cols.size == 0:
+            return pattern
+        box = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+        mask = (dy2[box[0], None] + dx2[None, box[1]]) < (radius**2)
+        # Masked copy in one pass, without the index arrays of boolean indexing
+        np.copyto(pattern[box], slit_phase, casting='unsafe', where=mask)
         return pattern
 
 
@@ -258,6 +302,7 @@ class PatternMultiplier(PatternGenerator):
 
     PARAM_GEN1 = "Pattern generator 1"
     PARAM_GEN2 = "Pattern generator 2"
+    BAND_ROWS = 64
 
     def define_params(self):
         pzp.param.text(self, self.PARAM_GEN1, BinaryGratingPattern.__name__)(None)
@@ -265,14 +310,32 @@ class PatternMultiplier(PatternGenerator):
         super().define_params()
 
     def generate_pattern(self, slm_dim):
-        pattern1 = self.puzzle[self[self.PARAM_GEN1].value].generate_pattern(slm_dim)  / 1023.0
-        pattern2 = self.puzzle[self[self.PARAM_GEN2].value].generate_pattern(slm_dim)  / 1023.0
-
-        new_pattern = (pattern1 * pattern2 * 1023).astype(int)
+        pattern1 = self.puzzle[self[self.PARAM_GEN1].value].generate_pattern(slm_dim)
+        pattern2 = self.puzzle[self[self.PARAM_GEN2].value].generate_pattern(slm_dim)
+
+        pattern1, pattern2 = np.broadcast_arrays(pattern1, pattern2)
+        new_pattern = np.empty(pattern1.shape, dtype=np.uint16)
+        # Processed by bands of rows so that the float32 product stays in cache. Slicing rows of the
+        # (often broadcast) sub-patterns is free.
+        band = np.empty((min(self.BAND_ROWS, pattern1.shape[0]),) + pattern1.shape[1:], dtype=np.float32)
+        for start in range(0, pattern1.shape[0], self.BAND_ROWS):
+            stop = min(start + self.BAND_ROWS, pattern1.shape[0])
+            tmp = band[:stop - start]
+            # p1/1023 * p2/1023 * 1023 is p1*p2/1023, products of grayscales are exact in float32
+            np.multiply(pattern1[start:stop], pattern2[start:stop], out=tmp, dtype=np.float32)
+            np.floor_divide(tmp, 1023, out=tmp)
+            new_pattern[start:stop] = tmp
         return new_pattern
 
 
 class BeamShaper(PatternGenerator):
+    # numpy names allowed in "Function to display", as np.<name>
+    ALLOWED_NP_NAMES = frozenset((
+        "pi", "e", "abs", "absolute", "sign", "sqrt", "square", "power", "exp", "exp2", "log", "log2", "log10",
+        "sin", "cos", "tan", "arcsin", "arccos", "arctan", "sinh", "cosh", "tanh", "sinc", "heaviside",
+        "floor", "ceil", "round", "mod", "minimum", "maximum", "clip", "where", "ones_like", "zeros_like",
+    ))
+
     def define_params(self):
         self.fetcher = util.CameraImageFetcher(self.puzzle)
         pzp.param.spinbox(self, "Period (px)", 29, 1, 1023)(None)
@@ -280,7 +343,34 @@ class BeamShaper(PatternGenerator):
         pzp.param.text(self, "Function to display", "1")(None)
         pzp.param.checkbox(self, "Sum along axis 0", False)(None)
         pzp.param.text(self, "Save file name", "woo.csv")(None)
+        self._function_cache = None
     
+    def compile_function(self, expression):
+        """
+        Compile the expression of "Function to display", which may only use x and the numpy functions and constants
+        of ALLOWED_NP_NAMES, as np.<name> (eg. np.exp(-x**2)). Any other name or attribute is rejected, so that
+        the expression can't reach modules through numpy (eg. np.f2py.os).
+        The compiled code is kept until the expression changes.
+
+        Args:
+            expression (str): Python expression of x.
+
+        Returns:
+            Code object to evaluate with eval(code, {"x": x, "np": np}).
+        """
+        if self._function_cache is None or self._function_cache[0] != expression:
+            tree = ast.parse(expression, mode="eval")
+            for node in ast.walk(tree):
+                if isinstance(node, ast.Name) and node.id not in ("x", "np"):
+                    raise ValueError(f"Unknown name in function: {node.id}")
+                if isinstance(node, ast.Attribute):
+                    if not (isinstance(node.value, ast.Name) and node.value.id == "np"):
+                        raise ValueError(f"Only np.<name> attributes are allowed in function: {ast.unparse(node)}")
+                    if node.attr not in self.ALLOWED_NP_NAMES:
+                        raise ValueError(f"numpy name not allowed in function: np.{node.attr}")
+            self._function_cache = (expression, compile(tree, "<Function to display>", "eval"))
+        return self._function_cache[1]
+
     def define_actions(self):
         @pzp.action.define(self, "Set background image")
         def set_background():
@@ -294,34 +384,42 @@ class BeamShaper(PatternGenerator):
             blazed = self.puzzle["BlazedGrating"]
             use_binary = self["Use binary"].value
             if use_binary:
-                binary[pat.BinaryGrating.PARAM_DUTY_CYCLE].set_value(0.5)
-                binary[pat.BinaryGrating.PARAM_PERIOD].set_value(period)
-                binary[pat.BinaryGrating.PARAM_PHASE].set_value(1023)
-                binary.actions[pat.BinaryGrating.ACTION_SEND]()
+                binary[BinaryGratingPattern.PARAM_DUTY_CYCLE].set_value(0.5)
+                binary[BinaryGratingPattern.PARAM_PERIOD].set_value(period)
+                binary[BinaryGratingPattern.PARAM_PHASE].set_value(1023)
+                binary.actions[BinaryGratingPattern.ACTION_SEND]()
             else:
-                blazed["Period"].set_value(period)
-                blazed["Max phase"].set_value(1023)
-                blazed.actions[PatternGenerator.ACTION_SEND]()
+                blazed[BlazedGratingPattern.PARAM_PERIOD].set_value(period)
+                blazed[BlazedGratingPattern.PARAM_PHASE].set_value(1023)
+                blazed.actions[BlazedGratingPattern.ACTION_SEND]()
             
-            image = self.puzzle["SLM"]["image"].value.astype(float)
+            slm = self.puzzle[slm_name]
+            image = slm[SLMPiece.PARAM_IMAGE].value.astype(np.float32)
             envelope_x = np.arange(0, image.shape[0])
-            envelope = np.array(eval(self["Function to display"].value, {"x": envelope_x, "np": np}))
+            code = self.compile_function(self["Function to display"].value)
+            envelope = np.array(eval(code, {"__builtins__": {}, "x": envelope_x, "np": np}))
             if np.any(envelope < 0) or np.max(envelope) > 1:
                 raise ValueError("Returned function contains invalid value")
             
             if use_binary:
-                phase_multiplier = np.arccos(np.sqrt(envelope)) / np.pi
+                # Constant functions (e.g. "1") evaluate to a scalar, one value per row is needed below
+                phase_multiplier = np.sqrt(np.broadcast_to(envelope, envelope_x.shape))
+                np.arccos(phase_multiplier, out=phase_multiplier)
+                phase_multiplier *= 1/np.pi
             else:
                 raise RuntimeError("Not yet supported")
             
-            image = (phase_multiplier * image.T).T
-            self.send_image_to_slm(image.astype(int))
+            # image is already a float32 copy, each row is scaled in place
+            image *= phase_multiplier[:, None]
+            slm[SLMPiece.PARAM_IMAGE].set_value(image.astype(np.uint16))
 
             X = 60
             beam_distrib = np.exp(-0.5*((envelope_x - np.max(envelope_x)/2) / X)**2)
             phase_mask = np.exp(1j*2*np.pi*phase_multiplier)
             expected = np.fft.ifftshift(np.fft.ifft(beam_distrib * phase_mask))
-            plt.scatter(np.arange(expected.size), np.abs(expected)**2)
+            # |z|**2 without the square root of np.abs
+            intensity = expected.real*expected.real + expected.imag*expected.imag
+            plt.scatter(np.arange(expected.size), intensity)
             plt.title("Expected")
             plt.show()
 
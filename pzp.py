@@ -54,14 +54,11 @@ class SLMPiece(image_preview.ImagePreview, pzp.Piece):
             display_nb = self[SLMPiece.PARAM_DISPLAY_NB].value
             slm_nb = self[SLMPiece.PARAM_CTRL_NB].value
 
-            itf.check_error(slm.SLM_Disp_Open(display_nb))
-            itf.check_error(slm.SLM_Ctrl_Open(slm_nb))
-
-            rcode, width, height = slm.SLM_Disp_Info(display_nb)
-            itf.check_error(rcode)
-
-            rcode, wavelength, phase = slm.SLM_Ctrl_ReadWL(slm_nb)
-            itf.check_error(rcode)
+            # Errors are raised by the interface itself
+            slm.SLM_Disp_Open(display_nb)
+            slm.SLM_Ctrl_Open(slm_nb)
+            _, width, height = slm.SLM_Disp_Info(display_nb)
+            _, wavelength, phase = slm.SLM_Ctrl_ReadWL(slm_nb)
 
             self[SLMPiece.PARAM_SLM_DIMENSIONS].set_value(np.array((height, width)))
             self[SLMPiece.PARAM_WAVELENGTH].set_value(wavelength)
@@ -72,8 +69,8 @@ class SLMPiece(image_preview.ImagePreview, pzp.Piece):
         def disconnect():
             if not self.puzzle.debug:
                 slm = self.puzzle.globals[SANTEC_SLM_API]
-                itf.check_error(slm.SLM_Disp_Close(self[SLMPiece.PARAM_DISPLAY_NB].value))
-                itf.check_error(slm.SLM_Ctrl_Close(self[SLMPiece.PARAM_CTRL_NB].value))
+                slm.SLM_Disp_Close(self[SLMPiece.PARAM_DISPLAY_NB].value)
+                slm.SLM_Ctrl_Close(self[SLMPiece.PARAM_CTRL_NB].value)
             return 0
         
         @pzp.param.array(self, self.PARAM_IMAGE)
@@ -88,11 +85,10 @@ class SLMPiece(image_preview.ImagePreview, pzp.Piece):
             if slm_dim[0] != value.shape[0] or slm_dim[1] != value.shape[1]:
                 raise ValueError(f"Pattern doesn't have dimension of SLM: SLM dim: {slm_dim}, pattern dim: {value.shape}")
             if not self.puzzle.debug:
-                rcode = self.puzzle.globals[SANTEC_SLM_API].SLM_Disp_Data(
+                self.puzzle.globals[SANTEC_SLM_API].SLM_Disp_Data(
                     self[SLMPiece.PARAM_DISPLAY_NB].value,
                     value.shape[1], value.shape[0],
                     itf.FLAGS_COLOR_GRAY, value)
-                itf.check_error(rcode)
             return value
     
     def define_actions(self):
@@ -107,10 +103,10 @@ class SLMPiece(image_preview.ImagePreview, pzp.Piece):
             phase = self[SLMPiece.PARAM_PHASE].value
             slm_nb = self[SLMPiece.PARAM_CTRL_NB].value
             slm = self.puzzle.globals[SANTEC_SLM_API]
-            itf.check_error(slm.SLM_Ctrl_WriteWL(slm_nb, wl, phase), "Write Wavelength:")
+            slm.SLM_Ctrl_WriteWL(slm_nb, wl, phase)
             
             if self[SLMPiece.PARAM_WL_SAVE].value:
-                itf.check_error(slm.SLM_Ctrl_WriteAW(slm_nb), "Save Wavelength:")
+                slm.SLM_Ctrl_WriteAW(slm_nb)
                 
         pzp.action.settings(self)
 
@@ -8,13 +8,18 @@ class CameraImageFetcher:
     def __init__(self, puzzle: pzp.Puzzle, wait_time: float=0):
         self.puzzle = puzzle
         self.wait_time = wait_time
+        self._buf = None  # Reused by get_processed_image
 
-    def get_image_from_camera(self):
+    def get_raw_image_from_camera(self):
         time.sleep(self.wait_time)
         self.puzzle.process_events()
         # time.sleep(0.05)
         # self.puzzle.process_events()
-        return self.puzzle["Camera"]["image"].value.astype(np.int16)
+        return self.puzzle["Camera"]["image"].value
+
+    def get_image_from_camera(self):
+        # C order whatever the layout of the camera image, as a copy since background keeps it
+        return self.get_raw_image_from_camera().astype(np.int16, order="C")
     
     # Should be useless as Camera piece can do it
     def set_backbround(self):
@@ -22,9 +27,19 @@ class CameraImageFetcher:
         print(self.background.dtype)
     
     def get_processed_image(self):
+        """
+        Camera image minus background, negative values set to 0.
+        The returned int16 array is overwritten by the next call, copy it to keep it.
+        """
         if not hasattr(self, "background"):
             self.background = 0
-        return np.maximum(0, self.get_image_from_camera() - self.background)
+        img = self.get_raw_image_from_camera()
+        if self._buf is None or self._buf.shape != img.shape:
+            self._buf = np.empty(img.shape, dtype=np.int16)
+        # Same int16 arithmetic as astype(np.int16) - background, without the temporaries
+        np.subtract(img, self.background, out=self._buf, dtype=np.int16, casting='unsafe')
+        np.maximum(self._buf, 0, out=self._buf)
+        return self._buf
     #
 
     def get_intensity(self):
@@ -34,9 +49,12 @@ class CameraImageFetcher:
 
 def get_sorted_peak_idx(image, axis=1, threshold=100):
     arr = np.sum(image, axis=axis)
-    local_max = (np.diff(arr, append=arr[-1]) < 0) & (np.diff(arr, prepend=arr[0]) > 0) & (arr > threshold)
+    # Strictly above both neighbours, the first and last points can't be peaks.
+    # A single diff gives the slope on both sides of each interior point.
+    slopes = np.diff(arr)
+    local_max = (slopes[:-1] > 0) & (slopes[1:] < 0) & (arr[1:-1] > threshold)
 
-    peak_idx = np.nonzero(local_max)[0]
+    peak_idx = np.flatnonzero(local_max) + 1
     sorted_peaks_idx = np.argsort(arr[peak_idx])[::-1]
 
     return peak_idx[sorted_peaks_idx]
@@ -44,10 +62,13 @@ def get_sorted_peak_idx(image, axis=1, threshold=100):
 # n: order of polynomial
 def fit(x, y, n):
     n += 1
-    power = np.arange(n)
-    X = np.tile(x, (n, 1)).T ** power
-    P = np.linalg.inv(X.T @ X)
-    parameters = P @ X.T @ y
+    X = np.vander(x, n, increasing=True)
+    # Least squares through the QR decomposition of X rather than the normal equations, whose
+    # conditioning is the square of the one of X. inv(X.T @ X) is inv(R) @ inv(R).T
+    Q, R = np.linalg.qr(X)
+    parameters = np.linalg.solve(R, Q.T @ y)
+    R_inv = np.linalg.inv(R)
+    P = R_inv @ R_inv.T
 
     N, p = X.shape
     delta_sq = np.sum( (y - X @ parameters)**2 ) / (N-p)
@@ -55,8 +76,8 @@ def fit(x, y, n):
 
 def simulate_fit(x, params):
     n = params.size
-    return np.tile(x, (n, 1)).T ** np.arange(0,n) @ params
+    return np.vander(x, n, increasing=True) @ params
 
 def save_csv(x, y, name):
-    data = np.vstack((x, y)).T
+    data = np.column_stack((x, y))
     np.savetxt(name, data)
\ No newline at end of file